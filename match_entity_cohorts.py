@@ -1,11 +1,99 @@
-import os
+import csv
+import functools
+import re
+import sys
 import logging
-from typing import Dict, List
+from dataclasses import dataclass
+from operator import attrgetter
+from typing import Callable, Dict, FrozenSet, List, Set, Tuple
 
 
 ENTITY_FILENAME = "entities.tsv"
 ENTITY_COHORT_FILENAME = "entity_cohorts.tsv"
 
+# Age ranges such as "[10,50]" or "(15,45]"
+AGE_RANGE_RE = re.compile(r"^([\[(])(-?\d+),(-?\d+)([\])])$")
+
+# Read files in 1 MiB chunks to cut down on read syscalls for large files
+READ_BUFFER_SIZE = 1 << 20
+
+# Cohort keys matched on exact value
+EXACT_MATCH_FIELDS = frozenset({"first_name", "last_name", "country", "zip_code"})
+
+# Order in which cohort predicates are evaluated, most selective first
+PREDICATE_SELECTIVITY = {
+    "zip_code": 0,
+    "last_name": 0,
+    "first_name": 0,
+    "country": 1,
+    "age": 2,
+    "emails": 3,
+}
+
+
+@dataclass(slots=True)
+class Entity:
+    eid: int
+    first_name: str
+    last_name: str
+    age: int
+    country: str
+    zip_code: str
+    emails: List[str]
+    email_domains: FrozenSet[str]
+
+
+def _compile_exact_match(key: str, value: str) -> Callable[[Entity], bool]:
+    """
+    Compile an exact value match, e.g. last_name:Chen
+    """
+    get = attrgetter(key)
+    return lambda e: get(e) == value
+
+
+def _compile_age_range(key: str, value: str) -> Callable[[Entity], bool]:
+    """
+    Compile an age range match, e.g. age:[10,50]
+    """
+    age_range = AGE_RANGE_RE.match(value)
+    if age_range is None:
+        raise ValueError(
+            "%s must be a range of the form [min,max], (min,max], "
+            "[min,max) or (min,max)" % value
+        )
+
+    min_range, min_age, max_age, max_range = age_range.groups()
+    lo = int(min_age)
+    hi = int(max_age)
+
+    # Check both bounds with a single chained comparison
+    if min_range == "[" and max_range == "]":
+        return lambda e: lo <= e.age <= hi
+    elif min_range == "[":
+        return lambda e: lo <= e.age < hi
+    elif max_range == "]":
+        return lambda e: lo < e.age <= hi
+    else:
+        return lambda e: lo < e.age < hi
+
+
+def _compile_email_domain(key: str, value: str) -> Callable[[Entity], bool]:
+    """
+    Compile an email domain match, e.g. emails:gmail.com
+    """
+    return lambda e: value in e.email_domains
+
+
+# Predicate compiler for each cohort key
+PREDICATE_COMPILERS = {
+    "first_name": _compile_exact_match,
+    "last_name": _compile_exact_match,
+    "country": _compile_exact_match,
+    "zip_code": _compile_exact_match,
+    "age": _compile_age_range,
+    "emails": _compile_email_domain,
+}
+
 
 class EntityCohortMatch:
     def __init__(self, entity_filepath: str, entity_cohort_filepath: str) -> None:
@@ -14,6 +102,38 @@ class EntityCohortMatch:
         self.entity_cohort_filepath = entity_cohort_filepath
         self.entity_data = self.parse_entities()
         self.entity_cohort_data = self.parse_entity_cohorts()
+        # Index entities by eid and cohorts by cohort ID for O(1) lookups
+        self.entity_by_eid = {row.eid: row for row in self.entity_data}
+        # Index eids by their exact-match values for bulk matching
+        self.entity_index: Dict[str, Dict[str, Set[int]]] = {
+            key: dict() for key in EXACT_MATCH_FIELDS
+        }
+        for row in self.entity_data:
+            for key in EXACT_MATCH_FIELDS:
+                value = getattr(row, key)
+                self.entity_index[key].setdefault(value, set()).add(row.eid)
+        self.cohort_by_id = {
+            row["cohort"]: i for i, row in enumerate(self.entity_cohort_data)
+        }
+        # Cohort rules are static, so parse them once into predicates
+        self.compiled_cohorts: List[Tuple[str, List[Callable[[Entity], bool]]]] = [
+            (row["cohort"], self._compile_cohort(row))
+            for row in self.entity_cohort_data
+        ]
+        # Inverted index of exact-match values to cohort positions, plus the
+        # cohorts that do not constrain each key and so are always candidates
+        self.cohort_index: Dict[str, Dict[str, Set[int]]] = {
+            key: dict() for key in EXACT_MATCH_FIELDS
+        }
+        self.cohorts_without_key: Dict[str, Set[int]] = {
+            key: set() for key in EXACT_MATCH_FIELDS
+        }
+        for i, row in enumerate(self.entity_cohort_data):
+            self._index_cohort(i, row)
+        # Memoize cohort matches per eid; cleared whenever cohorts change
+        self._cached_match_entity_cohorts = functools.lru_cache(maxsize=4096)(
+            self._match_entity_cohorts
+        )
 
     @staticmethod
     def get_logger() -> logging.Logger:
@@ -24,81 +144,103 @@ class EntityCohortMatch:
         )
         return logging.getLogger("entity_cohort_match")
 
-    def parse_entities(self) -> List[Dict]:
+    def parse_entities(self) -> List[Entity]:
         """
         Read in entities file
 
         Sample result:
         [
-            {
-                "eid": 1,
-                "first_name": "John",
-                "last_name": "Lee",
-                "age": 22,
-                "country": "US",
-                "zip_code": "91003",
-                "emails": ["jlee@yahoo.com", "johnl@aol.com", "jl123@gmail.com"],
-            },
-            {
-                "eid": 5,
-                "first_name": "Tom",
-                "last_name": "Tan",
-                "age": 81,
-                "country": "CH",
-                "zip_code": "349999",
-                "emails": [],
-            }
+            Entity(
+                eid=1,
+                first_name="John",
+                last_name="Lee",
+                age=22,
+                country="US",
+                zip_code="91003",
+                emails=["jlee@yahoo.com", "johnl@aol.com", "jl123@gmail.com"],
+                email_domains=frozenset({"yahoo.com", "aol.com", "gmail.com"}),
+            ),
+            Entity(
+                eid=5,
+                first_name="Tom",
+                last_name="Tan",
+                age=81,
+                country="CH",
+                zip_code="349999",
+                emails=[],
+                email_domains=frozenset(),
+            )
         ]
         """
         self.logger.info("Reading in %s:" % self.entity_filepath)
 
-        if os.path.exists(self.entity_filepath):
-            data = list()
-            data_format = {
-                "eid": 0,
-                "first_name": 1,
-                "last_name": 2,
-                "age": 3,
-                "country": 4,
-                "zip_code": 5,
-                "emails": 6,
-            }
-
-            with open(self.entity_filepath, "r") as file:
-                # For each line of the file
-                for line in file:
-                    # Exclude column header
-                    if not line.startswith("eid"):
-                        data_line = dict()
-                        # Split by tab
-                        columns = line.replace("\n", "").split("\t")
-
-                        # Map based on order
-                        for col, i in data_format.items():
-                            column_value = columns[i]
-
-                            # Handle columns that can be interpreted as a list of strings to be so
-                            if column_value.startswith("[") and column_value.endswith(
-                                "]"
-                            ):
-                                # Handle empty list
-                                if len(column_value) == 2:
-                                    data_line[col] = []
-                                else:
-                                    data_line[col] = column_value.strip("[]").split(",")
+        data = list()
+        data_format = {
+            "eid": 0,
+            "first_name": 1,
+            "last_name": 2,
+            "age": 3,
+            "country": 4,
+            "zip_code": 5,
+            "emails": 6,
+        }
+
+        try:
+            file = open(
+                self.entity_filepath, "r", buffering=READ_BUFFER_SIZE, newline=""
+            )
+        except FileNotFoundError as e:
+            raise IOError(
+                "The file path, %s, does not exist" % self.entity_filepath
+            ) from e
+
+        with file:
+            # Tokenize tab-separated rows in bulk
+            reader = csv.reader(file, delimiter="\t", quoting=csv.QUOTE_NONE)
+            # Exclude column header
+            next(reader, None)
+
+            # For each row of the file
+            for columns in reader:
+                # Skip blank lines
+                if columns:
+                    data_line = dict()
+
+                    # Map based on order
+                    for col, i in data_format.items():
+                        column_value = columns[i]
+
+                        # Handle columns that can be interpreted as a list of strings to be so
+                        if column_value.startswith("[") and column_value.endswith("]"):
+                            # Handle empty list
+                            if len(column_value) == 2:
+                                data_line[col] = []
+                            else:
+                                data_line[col] = column_value.strip("[]").split(",")
+                        else:
+                            # Data type handling
+                            if col in ("eid", "age"):
+                                data_line[col] = int(column_value)
+                            # Intern exact-match values so comparisons
+                            # against cohort values hit the identity fast path
+                            elif col in EXACT_MATCH_FIELDS:
+                                data_line[col] = sys.intern(column_value)
                             else:
-                                # Data type handling
-                                if col in ("eid", "age"):
-                                    data_line[col] = int(column_value)
-                                else:
-                                    data_line[col] = column_value
+                                data_line[col] = column_value
 
-                        data.append(data_line)
-        else:
-            raise IOError("The file path, %s, does not exist" % self.entity_filepath)
+                    # Pre-compute email domains for cohort matching
+                    data_line["email_domains"] = frozenset(
+                        email.rsplit("@", 1)[1]
+                        for email in data_line["emails"]
+                        if "@" in email
+                    )
+
+                    data.append(Entity(**data_line))
 
-        for row in data:
-            self.logger.info(row)
+        # Only dump parsed rows when debugging, as this is per row
+        if self.logger.isEnabledFor(logging.DEBUG):
+            for row in data:
+                self.logger.debug(row)
 
         return data
 
@@ -116,88 +258,185 @@ class EntityCohortMatch:
         """
         self.logger.info("Reading in %s:" % self.entity_cohort_filepath)
 
-        if os.path.exists(self.entity_cohort_filepath):
-            data = list()
+        data = list()
 
-            with open(self.entity_cohort_filepath, "r") as file:
-                # For each line of the file
-                for line in file:
+        try:
+            file = open(
+                self.entity_cohort_filepath, "r", buffering=READ_BUFFER_SIZE, newline=""
+            )
+        except FileNotFoundError as e:
+            raise IOError(
+                "The file path, %s, does not exist" % self.entity_cohort_filepath
+            ) from e
+
+        with file:
+            # Tokenize tab-separated rows in bulk
+            reader = csv.reader(file, delimiter="\t", quoting=csv.QUOTE_NONE)
+
+            # For each row of the file
+            for columns in reader:
+                # Skip blank lines
+                if columns:
                     data_line = dict()
-                    # Split by tab
-                    columns = line.replace("\n", "").split("\t")
 
                     # Map based on key/value
                     for col_mapping in columns:
-                        col_mapping = col_mapping.split(":")
+                        col_mapping = col_mapping.split(":", 1)
+                        if col_mapping[0] in EXACT_MATCH_FIELDS:
+                            col_mapping[1] = sys.intern(col_mapping[1])
                         data_line[col_mapping[0]] = col_mapping[1]
 
                     data.append(data_line)
-        else:
-            raise IOError(
-                "The file path, %s, does not exist" % self.entity_cohort_filepath
-            )
 
-        for row in data:
-            self.logger.info(row)
+        # Only dump parsed rows when debugging, as this is per row
+        if self.logger.isEnabledFor(logging.DEBUG):
+            for row in data:
+                self.logger.debug(row)
 
         return data
 
+    @staticmethod
+    def _compile_cohort(cohort_row: Dict) -> List[Callable[[Entity], bool]]:
+        """
+        Compile a cohort's rules into predicates over an entity row, ordered by
+        PREDICATE_SELECTIVITY
+
+        Sample result for {"cohort": "1", "last_name": "Chen", "age": "[10,50]"}:
+        [
+            lambda e: e.last_name == "Chen",
+            lambda e: 10 <= e.age <= 50,
+        ]
+        """
+        predicates = list()
+
+        for key, value in cohort_row.items():
+            # Exclude cohort
+            if key == "cohort":
+                continue
+
+            compile_predicate = PREDICATE_COMPILERS.get(key)
+            if compile_predicate is None:
+                raise ValueError("The key, %s, is not expected" % key)
+
+            predicates.append((key, compile_predicate(key, value)))
+
+        # Evaluate the most selective predicates first so mismatches exit early
+        predicates.sort(key=lambda pair: PREDICATE_SELECTIVITY[pair[0]])
+
+        return [predicate for _, predicate in predicates]
+
+    def _index_cohort(self, i: int, cohort_row: Dict) -> None:
+        """
+        Add the cohort at position i to the exact-match inverted index
+        """
+        for key in EXACT_MATCH_FIELDS:
+            if key in cohort_row:
+                self.cohort_index[key].setdefault(cohort_row[key], set()).add(i)
+            else:
+                self.cohorts_without_key[key].add(i)
+
+    def _unindex_cohort(self, i: int, cohort_row: Dict) -> None:
+        """
+        Remove the cohort at position i from the exact-match inverted index
+        """
+        for key in EXACT_MATCH_FIELDS:
+            if key in cohort_row:
+                self.cohort_index[key][cohort_row[key]].discard(i)
+            else:
+                self.cohorts_without_key[key].discard(i)
+
     def find_entity_cohorts(self, eid: int) -> List[str]:
         """
         Find all cohort ID's ("cohort") associated with a specified entity ID ("eid")
         """
+        # Copy so callers cannot modify the cached result
+        return list(self._cached_match_entity_cohorts(eid))
+
+    def _match_entity_cohorts(self, eid: int) -> List[str]:
+        """
+        Match an entity against all cohorts, bypassing the cache
+        """
         cohort_results = list()
-        entity_row = [row for row in self.entity_data if row["eid"] == eid][0]
-
-        for cohort_row in self.entity_cohort_data:
-            this_cohort_matches = True
-
-            for key, value in cohort_row.items():
-                # Exclude cohort
-                if key == "cohort":
-                    continue
-                # Exact value matches
-                if key in ("first_name", "last_name", "country", "zip_code"):
-                    if entity_row[key] != cohort_row[key]:
-                        this_cohort_matches = False
-                # Age range matches
-                elif key == "age":
-                    min_range = cohort_row[key][0]
-                    max_range = cohort_row[key][-1]
-                    min_max_age_ranges = cohort_row[key].strip("[]()").split(",")
-                    min_age = int(min_max_age_ranges[0])
-                    max_age = int(min_max_age_ranges[1])
-
-                    if min_range == "(":
-                        if entity_row[key] <= min_age:
-                            this_cohort_matches = False
-                    elif min_range == "[":
-                        if entity_row[key] < min_age:
-                            this_cohort_matches = False
-                    else:
-                        raise ValueError("%s must be [ or ( only" % min_range)
-
-                    if max_range == ")":
-                        if entity_row[key] >= max_age:
-                            this_cohort_matches = False
-                    elif max_range == "]":
-                        if entity_row[key] > max_age:
-                            this_cohort_matches = False
-                    else:
-                        raise ValueError("%s must be ] or ) only" % max_range)
-                # Email domain matches
-                elif key == "emails":
-                    entity_email_domains = [
-                        email.split("@")[1] for email in entity_row[key]
-                    ]
-
-                    if cohort_row[key] not in entity_email_domains:
-                        this_cohort_matches = False
-                else:
-                    raise ValueError("The key, %s, is not expected" % key)
-
-            if this_cohort_matches:
-                cohort_results.append(cohort_row["cohort"])
+        entity_row = self.entity_by_eid[eid]
+        # Bind attributes used in the loops to locals
+        cohort_index = self.cohort_index
+        cohorts_without_key = self.cohorts_without_key
+        compiled_cohorts = self.compiled_cohorts
+
+        # Only cohorts whose exact-match values agree with the entity are candidates
+        candidates = set.intersection(
+            *(
+                cohort_index[key].get(getattr(entity_row, key), set())
+                | cohorts_without_key[key]
+                for key in EXACT_MATCH_FIELDS
+            )
+        )
+
+        # Verify the remaining predicates, keeping cohort order
+        for i in sorted(candidates):
+            cohort, predicates = compiled_cohorts[i]
+
+            for predicate in predicates:
+                # Stop at the first mismatch
+                if not predicate(entity_row):
+                    break
+            else:
+                cohort_results.append(cohort)
+
+        return cohort_results
+
+    def find_entity_cohorts_bulk(self) -> Dict[int, List[str]]:
+        """
+        Find all cohort ID's ("cohort") for every entity ID ("eid") at once
+
+        Sample result:
+        {1: ["3", "4"], 2: [], 3: [], 4: ["2"], 5: []}
+        """
+        return self.find_cohorts_for_eids(list(self.entity_by_eid))
+
+    def find_cohorts_for_eids(self, eids: List[int]) -> Dict[int, List[str]]:
+        """
+        Find all cohort ID's ("cohort") for each of the specified entity ID's ("eid")
+        in a single pass over the cohorts
+
+        Each cohort narrows the entities by its exact-match values using set
+        intersections on the entity index, then filters the remaining entities
+        one predicate at a time
+
+        Sample result for eids [4, 1]:
+        {4: ["2"], 1: ["3", "4"]}
+        """
+        cohort_results = {eid: list() for eid in eids}
+        # Bind attributes used in the loops to locals
+        entity_by_eid = self.entity_by_eid
+        entity_index = self.entity_index
+        entities = [entity_by_eid[eid] for eid in cohort_results]
+        eid_set = set(cohort_results)
+
+        for cohort_row, (cohort, predicates) in zip(
+            self.entity_cohort_data, self.compiled_cohorts
+        ):
+            exact_match_keys = [key for key in EXACT_MATCH_FIELDS if key in cohort_row]
+
+            if exact_match_keys:
+                matched_eids = eid_set.intersection(
+                    *(
+                        entity_index[key].get(cohort_row[key], set())
+                        for key in exact_match_keys
+                    )
+                )
+                candidates = [entity_by_eid[eid] for eid in matched_eids]
+            else:
+                candidates = entities
+
+            for predicate in predicates:
+                # Stop once no entity can match
+                if not candidates:
+                    break
+                candidates = [row for row in candidates if predicate(row)]
+
+            for row in candidates:
+                cohort_results[row.eid].append(cohort)
 
         return cohort_results
 
@@ -206,29 +445,40 @@ class EntityCohortMatch:
         Add a new cohort or update a pre-existing cohort
         """
         cohort_row = dict()
-        cohort_found_and_replaced = False
 
-        # Split by tab
-        columns = cohort.split("\t")
+        # Split by tab, ignoring any trailing line ending
+        columns = cohort.rstrip("\r\n").split("\t")
 
         # Map based on key/value
         for col_mapping in columns:
-            col_mapping = col_mapping.split(":")
+            col_mapping = col_mapping.split(":", 1)
+            if col_mapping[0] in EXACT_MATCH_FIELDS:
+                col_mapping[1] = sys.intern(col_mapping[1])
             cohort_row[col_mapping[0]] = col_mapping[1]
 
+        compiled_cohort = (cohort_row["cohort"], self._compile_cohort(cohort_row))
+
         # Replace if already exists
-        for i in range(len(self.entity_cohort_data)):
-            if cohort_row["cohort"] == self.entity_cohort_data[i]["cohort"]:
-                self.entity_cohort_data[i] = cohort_row
+        i = self.cohort_by_id.get(cohort_row["cohort"])
+        if i is not None:
+            self._unindex_cohort(i, self.entity_cohort_data[i])
+            self.entity_cohort_data[i] = cohort_row
+            self.compiled_cohorts[i] = compiled_cohort
+            if self.logger.isEnabledFor(logging.INFO):
                 self.logger.info(
                     "Cohort %s found and replaced as %s" % (cohort, cohort_row)
                 )
-                cohort_found_and_replaced = True
-
-        # If not replaced, add it
-        if not cohort_found_and_replaced:
+        # If not found, add it
+        else:
+            i = len(self.entity_cohort_data)
+            self.cohort_by_id[cohort_row["cohort"]] = i
             self.entity_cohort_data.append(cohort_row)
-            self.logger.info("Cohort %s added as %s" % (cohort, cohort_row))
+            self.compiled_cohorts.append(compiled_cohort)
+            if self.logger.isEnabledFor(logging.INFO):
+                self.logger.info("Cohort %s added as %s" % (cohort, cohort_row))
+
+        self._index_cohort(i, cohort_row)
+        self._cached_match_entity_cohorts.cache_clear()
 
         # Return True if cohort added or updated successfully
         return True
@@ -249,6 +499,14 @@ def main():
     assert entity.find_entity_cohorts(eid=3) == []
     assert entity.find_entity_cohorts(eid=4) == ["2"]
     assert entity.find_entity_cohorts(eid=5) == []
+    assert entity.find_entity_cohorts_bulk() == {
+        1: ["3", "4"],
+        2: [],
+        3: [],
+        4: ["2"],
+        5: [],
+    }
+    assert entity.find_cohorts_for_eids(eids=[4, 1]) == {4: ["2"], 1: ["3", "4"]}
     assert entity.entity_cohort_data[4] == {
         "cohort": "5",
         "last_name": "Jackson",